@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 
 from io import BytesIO
-from typing import Union, Dict, NamedTuple, IO
-from os import fstat, walk
-from os.path import isdir, join as join_path
-from struct import unpack
+from collections import OrderedDict
+from threading import Lock
+from mmap import mmap, ACCESS_READ
+from typing import Union, Dict, NamedTuple, IO, Optional, Callable, Tuple, Iterator, List
+from struct import Struct, unpack, unpack_from
 from enum import Enum
-from os import PathLike
+from re import compile as compile_regex
+from os import PathLike, stat
 
-__all__ = 'ImInfo', 'ImError', 'ImFormat', 'get_image_size', 'get_image_size_from_path', 'get_image_size_from_reader'
+try:
+    from os import posix_fadvise, POSIX_FADV_SEQUENTIAL, POSIX_FADV_WILLNEED
+    HAS_FADVISE = True
+except ImportError:
+    # not available on Windows and macOS
+    HAS_FADVISE = False
+
+__all__ = 'ImInfo', 'ImError', 'ImFormat', 'get_image_size', 'get_image_size_from_path', 'get_image_size_from_reader', 'get_image_size_cached'
 
 # Original source: https://stackoverflow.com/questions/15800704/get-image-size-without-loading-image-into-memory
 #-------------------------------------------------------------------------------
@@ -23,6 +32,10 @@ __all__ = 'ImInfo', 'ImError', 'ImFormat', 'get_image_size', 'get_image_size_fro
 # Licence:     MIT
 #-------------------------------------------------------------------------------
 
+CHUNK_SIZE = 4096
+BUFFER_SIZE = 65536
+CACHE_SIZE = 1024
+
 TIFF_TYPES = [
     (1, "B"),  #  1 BYTE
     (1, "c"),  #  2 ASCII
@@ -38,8 +51,17 @@ TIFF_TYPES = [
     (8, "d")   # 12 DOUBLE
 ]
 
-TIFF_TYPES_BE = [(sz, '>' + fmt) for sz, fmt in TIFF_TYPES]
-TIFF_TYPES_LE = [(sz, '<' + fmt) for sz, fmt in TIFF_TYPES]
+TIFF_TYPES_BE = [(sz, Struct('>' + fmt)) for sz, fmt in TIFF_TYPES]
+TIFF_TYPES_LE = [(sz, Struct('<' + fmt)) for sz, fmt in TIFF_TYPES]
+
+# a JPEG marker is 0xFF, optionally followed by more 0xFF fill bytes, and then
+# the marker code
+JPEG_MARKER = compile_regex(b'\xff+[^\xff]')
+
+USHORT_BE = Struct('>H')
+USHORT_LE = Struct('<H')
+ULONG_BE  = Struct('>L')
+ULONG_LE  = Struct('<L')
 
 class ImFormat(Enum):
     GIF     =  1
@@ -117,21 +139,42 @@ class ImInfo(NamedTuple):
     height: int
     format: ImFormat
 
+def read_exact(file: IO[bytes], size: int, format: ImFormat) -> bytes:
+    buf = file.read(size)
+    if len(buf) < size:
+        raise ParserError(format)
+    return buf
+
+def map_file(file: IO[bytes]) -> Optional[mmap]:
+    """
+    Map file read-only into memory. Returns None if it isn't backed by a
+    regular, non-empty file (e.g. BytesIO, a pipe or a reader without fileno()).
+    """
+    fileno = getattr(file, 'fileno', None)
+    if fileno is None:
+        return None
+
+    try:
+        return mmap(fileno(), 0, access=ACCESS_READ)
+    except (OSError, ValueError):
+        # io.UnsupportedOperation is both
+        return None
+
 def find_riff_chunk(file: IO[bytes], name: bytes, chunk_size: int, format: ImFormat) -> int:
     sub_chunk_size: int
     offset = 0
 
     while True:
-        if offset > chunk_size:
+        if offset + 8 > chunk_size:
             raise ParserError(format)
 
-        buf = file.read(8)
-        sub_chunk_size, = unpack(">I", buf[:4])
-        
+        buf = read_exact(file, 8, format)
+        sub_chunk_size = int.from_bytes(buf[:4], 'big')
+
         if sub_chunk_size < 8:
             raise ParserError(format)
 
-        if buf[4:] == name:
+        if buf.startswith(name, 4):
             break
 
         offset += sub_chunk_size
@@ -140,9 +183,46 @@ def find_riff_chunk(file: IO[bytes], name: bytes, chunk_size: int, format: ImFor
     return sub_chunk_size
 
 def get_image_size_from_path(file_path: Union[str, PathLike]) -> ImInfo:
-    with open(file_path, 'rb') as input:
+    # small reads and seeks of the box/IFD walkers are served from the buffer
+    with open(file_path, 'rb', buffering=BUFFER_SIZE) as input:
+        if HAS_FADVISE:
+            # let the kernel read ahead the headers in one go
+            fd = input.fileno()
+            try:
+                posix_fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+                posix_fadvise(fd, 0, BUFFER_SIZE, POSIX_FADV_WILLNEED)
+            except OSError:
+                # e.g. not supported for pipes
+                pass
         return get_image_size_from_reader(input)
 
+IMAGE_SIZE_CACHE: 'OrderedDict[Tuple[int, int, int, int], ImInfo]' = OrderedDict()
+IMAGE_SIZE_CACHE_LOCK = Lock()
+
+def get_image_size_cached(file_path: Union[str, PathLike]) -> ImInfo:
+    """
+    Like get_image_size_from_path(), but remembers the result of the last
+    CACHE_SIZE files, identified by device, inode, modification time and size.
+    Repeated lookups of an unchanged file (also via links) don't re-read it.
+    """
+    meta = stat(file_path)
+    key = (meta.st_dev, meta.st_ino, meta.st_mtime_ns, meta.st_size)
+
+    with IMAGE_SIZE_CACHE_LOCK:
+        info = IMAGE_SIZE_CACHE.get(key)
+        if info is not None:
+            IMAGE_SIZE_CACHE.move_to_end(key)
+            return info
+
+    info = get_image_size_from_path(file_path)
+
+    with IMAGE_SIZE_CACHE_LOCK:
+        IMAGE_SIZE_CACHE[key] = info
+        if len(IMAGE_SIZE_CACHE) > CACHE_SIZE:
+            IMAGE_SIZE_CACHE.popitem(last=False)
+
+    return info
+
 def get_image_size_from_buffer(buffer: Union[bytes, bytearray, memoryview]) -> ImInfo:
     return get_image_size_from_reader(BytesIO(buffer))
 
@@ -155,341 +235,534 @@ def get_image_size(input: Union[str, PathLike, bytes, bytearray, memoryview, IO[
 
     return get_image_size_from_reader(input)
 
-def get_image_size_from_reader(input: IO[bytes]) -> ImInfo:
-    """
-    Return (width, height, format) for a given image file content.
-    input must be seekable. May raise ImError.
-    """
+def parse_gif(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if size < 10 or not (data.startswith(b'GIF87a') or data.startswith(b'GIF89a')):
+        return None
 
-    data = input.read(30)
-    if isinstance(input, BytesIO):
-        size = len(input.getbuffer())
-    else:
-        meta = fstat(input.fileno())
-        size = meta.st_size
-
-    if size >= 10 and (data.startswith(b'GIF87a') or data.startswith(b'GIF89a')):
-        # GIFs
-        width, height = unpack("<HH", data[6:10])
-        return ImInfo(width, height, ImFormat.GIF)
-    elif data.startswith(b'\x89PNG\r\n\x1a\n'):
-        # PNG
-        if size < 24:
-            raise ParserError(ImFormat.PNG)
-
-        chunk_size, = unpack(">L", data[8:12])
-        if chunk_size < 0 or data[12:16] != b'IHDR':
-            raise ParserError(ImFormat.PNG)
-
-        width, height = unpack(">LL", data[16:24])
-        return ImInfo(width, height, ImFormat.PNG)
-    elif size >= 7 and data.startswith(b"\xff\xd8"):
-        # JPEG
-        input.seek(3)
-        b = data[2:3]
-        try:
-            while b and b != b'\xDA':
-                while b != b'\xFF':
-                    b = input.read(1)
-                    if not b:
-                        raise ParserError(ImFormat.JPEG)
-                while b == b'\xFF':
-                    b = input.read(1)
-                    if not b:
-                        raise ParserError(ImFormat.JPEG)
-                b0 = b[0]
-                if b0 >= 0xC0 and b0 <= 0xC3:
-                    input.seek(3, 1)
-                    height, width = unpack(">HH", input.read(4))
-                    return ImInfo(width, height, ImFormat.JPEG)
-                else:
-                    input.seek(unpack(">H", input.read(2))[0] - 2, 1)
-                b = input.read(1)
+    width, height = unpack("<HH", data[6:10])
+    return ImInfo(width, height, ImFormat.GIF)
+
+def parse_png(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if not data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return None
 
+    if size < 24:
+        raise ParserError(ImFormat.PNG)
+
+    chunk_size = int.from_bytes(data[8:12], 'big')
+    if chunk_size < 0 or not data.startswith(b'IHDR', 12):
+        raise ParserError(ImFormat.PNG)
+
+    width, height = unpack(">LL", data[16:24])
+    return ImInfo(width, height, ImFormat.PNG)
+
+def parse_jpeg(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    # no size check needed, a truncated header ends the scan below
+    buf = data
+    pos = 2
+    while True:
+        # sync to the next marker, skipping any fill bytes
+        match = JPEG_MARKER.search(buf, pos)
+        while match is None:
+            # keep a trailing 0xFF, the marker might continue in the next block
+            tail = b'\xff' if pos < len(buf) and buf[-1] == 0xFF else b''
+            chunk = input.read(CHUNK_SIZE)
+            if not chunk:
+                raise ParserError(ImFormat.JPEG)
+            buf = tail + chunk
+            pos = 0
+            match = JPEG_MARKER.search(buf)
+
+        pos = match.end()
+        marker = buf[pos - 1]
+        if marker == 0xDA:
+            # start of scan, but no start of frame yet
             raise ParserError(ImFormat.JPEG)
-        except Exception as error:
-            raise ParserError(ImFormat.JPEG) from error
-    elif data.startswith(b'RIFF') and size >= 30 and data[8:12] == b'WEBP':
-        # WEBP
-        # learned format from: https://wiki.tcl-lang.org/page/Reading+WEBP+image+dimensions
-        hdr = data[12:16]
-        if hdr == b'VP8L':
-            b0 = data[21]
-            b1 = data[22]
-            b2 = data[23]
-            b3 = data[24]
-            width  = 1 + (((b1 & 0x3F) << 8) | b0)
-            height = 1 + (((b3 & 0xF) << 10) | (b2 << 2) | ((b1 & 0xC0) >> 6))
-        elif hdr == b'VP8 ':
-            b0 = data[23]
-            b1 = data[24]
-            b2 = data[25]
-            if b0 != 0x9d or b1 != 0x01 or b2 != 0x2a:
-                raise ParserError(ImFormat.WEBP)
-            w, h = unpack("<HH", data[26:30])
-            width  = w & 0x3ffff
-            height = h & 0x3ffff
-        elif hdr == b'VP8X':
-            w1 = data[24]
-            w2 = data[25]
-            w3 = data[26]
-            h1 = data[27]
-            h2 = data[28]
-            h3 = data[29]
-
-            width  = (w1 | w2 << 8 | w3 << 16) + 1
-            height = (h1 | h2 << 8 | h3 << 16) + 1
-        else:
+
+        is_sof = marker >= 0xC0 and marker <= 0xC3
+        need = 7 if is_sof else 2
+        if len(buf) - pos < need:
+            buf = buf[pos:] + input.read(CHUNK_SIZE)
+            pos = 0
+            if len(buf) < need:
+                raise ParserError(ImFormat.JPEG)
+
+        if is_sof:
+            height, width = unpack_from(">HH", buf, pos + 3)
+            return ImInfo(width, height, ImFormat.JPEG)
+
+        segment_size, = unpack_from(">H", buf, pos)
+        if segment_size < 2:
+            raise ParserError(ImFormat.JPEG)
+
+        pos += segment_size
+        if pos > len(buf):
+            input.seek(pos - len(buf), 1)
+            buf = input.read(CHUNK_SIZE)
+            pos = 0
+
+def parse_webp(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if size < 30 or not data.startswith(b'WEBP', 8):
+        return None
+
+    # learned format from: https://wiki.tcl-lang.org/page/Reading+WEBP+image+dimensions
+    hdr = data[12:16]
+    if hdr == b'VP8L':
+        # 14 bits width - 1, 14 bits height - 1
+        bits, = unpack_from("<I", data, 21)
+        width  = 1 + (bits & 0x3FFF)
+        height = 1 + ((bits >> 14) & 0x3FFF)
+    elif hdr == b'VP8 ':
+        if not data.startswith(b'\x9d\x01\x2a', 23):
             raise ParserError(ImFormat.WEBP)
+        w, h = unpack_from("<HH", data, 26)
+        width  = w & 0x3ffff
+        height = h & 0x3ffff
+    elif hdr == b'VP8X':
+        # 24 bits width - 1, 24 bits height - 1
+        lo, hi = unpack_from("<HI", data, 24)
+        width  = (lo | (hi & 0xFF) << 16) + 1
+        height = (hi >> 8) + 1
+    else:
+        raise ParserError(ImFormat.WEBP)
 
-        return ImInfo(width, height, ImFormat.WEBP)
-    elif data[4:12] in (b'ftypavif', b'ftypheic'):
-        # AVIF and HEIF
-        ftype_size, = unpack(">I", data[0:4])
-        input.seek(ftype_size)
+    return ImInfo(width, height, ImFormat.WEBP)
 
-        format = ImFormat.AVIF if data[8:12] == b'avif' else ImFormat.HEIF
+def parse_avif(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    # AVIF and HEIF
+    ftype_size = int.from_bytes(data[0:4], 'big')
+    input.seek(ftype_size)
 
-        # chunk nesting: meta > iprp > ipco > ispe
-        # search meta chunk
-        chunk_size = find_riff_chunk(input, b"meta", 0xFFFF_FFFF_FFFF_FFFF, format)
-        if chunk_size < 12:
-            raise ParserError(format)
+    format = ImFormat.AVIF if data.startswith(b'avif', 8) else ImFormat.HEIF
 
-        input.seek(4, 1)
-        chunk_size = find_riff_chunk(input, b"iprp", chunk_size - 12, format)
-        chunk_size = find_riff_chunk(input, b"ipco", chunk_size -  8, format)
-        chunk_size = find_riff_chunk(input, b"ispe", chunk_size -  8, format)
+    # chunk nesting: meta > iprp > ipco > ispe
+    # search meta chunk
+    chunk_size = find_riff_chunk(input, b"meta", 0xFFFF_FFFF_FFFF_FFFF, format)
+    if chunk_size < 12:
+        raise ParserError(format)
 
-        if chunk_size < 12:
-            raise ParserError(format)
+    # skip version and flags of the meta full box
+    input.seek(4, 1)
+    chunk_size -= 4
+    for name in (b"iprp", b"ipco", b"ispe"):
+        chunk_size = find_riff_chunk(input, name, chunk_size - 8, format)
 
-        data = input.read(12)
-        if len(data) < 12:
-            raise ParserError(format)
-        width, height = unpack(">II", data[4:])
-        return ImInfo(width, height, format)
-    elif size >= 24 and data.startswith(b"\0\0\0\x0CjP  ") and data[16:24] == b"ftypjp2 ":
-        # JPEG 2000
-        chunk_size, = unpack(">I", data[12:16])
-        input.seek(12 + chunk_size)
-
-        chunk_size = find_riff_chunk(input, b"jp2h", 0xFFFF_FFFF_FFFF_FFFF, ImFormat.JP2K)
-        chunk_size = find_riff_chunk(input, b"ihdr", chunk_size, ImFormat.JP2K)
-
-        if chunk_size < 8:
-            raise ParserError(ImFormat.JP2K)
-
-        data = input.read(8)
-        if len(data) < 8:
-            raise ParserError(ImFormat.JP2K)
-
-        height, width = unpack(">II", data)
-        return ImInfo(width, height, ImFormat.JP2K)
-    elif data.startswith(b'BM') and data[6:10] == b'\0\0\0\0':
-        # BMP
-        file_size, = unpack("<I", data[2:6])
-        min_size = min(file_size, size)
-        if min_size < 22:
+    if chunk_size < 12:
+        raise ParserError(format)
+
+    data = read_exact(input, 12, format)
+    width, height = unpack(">II", data[4:])
+    return ImInfo(width, height, format)
+
+def parse_jp2k(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    if not data.startswith(b"\0\0\0\x0CjP  ") or not data.startswith(b"ftypjp2 ", 16):
+        return None
+
+    chunk_size = int.from_bytes(data[12:16], 'big')
+    input.seek(12 + chunk_size)
+
+    chunk_size = find_riff_chunk(input, b"jp2h", 0xFFFF_FFFF_FFFF_FFFF, ImFormat.JP2K)
+    chunk_size = find_riff_chunk(input, b"ihdr", chunk_size, ImFormat.JP2K)
+
+    if chunk_size < 8:
+        raise ParserError(ImFormat.JP2K)
+
+    data = read_exact(input, 8, ImFormat.JP2K)
+
+    height, width = unpack(">II", data)
+    return ImInfo(width, height, ImFormat.JP2K)
+
+def parse_bmp(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if not data.startswith(b'\0\0\0\0', 6):
+        return None
+
+    file_size = int.from_bytes(data[2:6], 'little')
+    min_size = min(file_size, size)
+    if min_size < 22:
+        raise ParserError(ImFormat.BMP)
+
+    header_size = int.from_bytes(data[14:18], 'little')
+    if header_size == 12:
+        width, height = unpack("<hh", data[18:22])
+    else:
+        if min_size < 26 or header_size <= 12:
             raise ParserError(ImFormat.BMP)
+        width, height = unpack("<ii", data[18:26])
+    # height is negative when stored upside down
+    return ImInfo(width, abs(height), ImFormat.BMP)
+
+def parse_tiff(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if size < 8:
+        return None
+
+    # from here: https://github.com/scardine/image_size
+    # Standard TIFF, big- or little-endian
+    # BigTIFF and other different but TIFF-like formats are not
+    # supported currently
+    byteOrder = data[:2]
+    # maps TIFF type id to size (in bytes)
+    # and struct for the value
+    if byteOrder == b"MM":
+        tiffTypes = TIFF_TYPES_BE
+        ulong  = ULONG_BE
+        ushort = USHORT_BE
+    else:
+        tiffTypes = TIFF_TYPES_LE
+        ulong  = ULONG_LE
+        ushort = USHORT_LE
+    ifdOffset = ulong.unpack_from(data, 4)[0]
+    # The first IFD usually directly follows the header and thus is already
+    # in data. If it is somewhere else (e.g. after the image data) map the
+    # file, so that the IFD and the values it points to can be accessed
+    # without any further reads and seeks.
+    if ifdOffset + 2 <= size and ifdOffset + 2 + ushort.unpack_from(data, ifdOffset)[0] * 12 <= size:
+        return parse_tiff_ifd(input, data, ifdOffset, tiffTypes, ushort, ulong)
+
+    mapped = map_file(input)
+    if mapped is None:
+        return parse_tiff_ifd(input, data, ifdOffset, tiffTypes, ushort, ulong)
+
+    with mapped:
+        return parse_tiff_ifd(input, mapped, ifdOffset, tiffTypes, ushort, ulong)
+
+def parse_tiff_ifd(input: IO[bytes], buf: Union[bytes, mmap], ifdOffset: int,
+                   tiffTypes: List[Tuple[int, Struct]], ushort: Struct, ulong: Struct) -> ImInfo:
+    # Parts that are not in buf are read from input, all IFD entries at once.
+    size = len(buf)
+    countSize = 2
+    if ifdOffset + countSize <= size:
+        ifdEntryCount = ushort.unpack_from(buf, ifdOffset)[0]
+    else:
+        input.seek(ifdOffset)
+        ifdEntryCount = ushort.unpack(read_exact(input, countSize, ImFormat.TIFF))[0]
+    # 2 bytes: TagId + 2 bytes: type + 4 bytes: count of values + 4
+    # bytes: value offset
+    ifdEntrySize = 12
+    entriesOffset = ifdOffset + countSize
+    entriesSize   = ifdEntryCount * ifdEntrySize
+    if entriesOffset + entriesSize <= size:
+        ifd = buf
+        entriesEnd = entriesOffset + entriesSize
+    else:
+        input.seek(entriesOffset)
+        ifd = input.read(entriesSize)
+        entriesOffset = 0
+        entriesEnd = len(ifd) - len(ifd) % ifdEntrySize
+    width  = -1
+    height = -1
+    for entryOffset in range(entriesOffset, entriesEnd, ifdEntrySize):
+        tag = ushort.unpack_from(ifd, entryOffset)[0]
+        if tag > 257:
+            # entries are sorted by tag, so width and height can't follow
+            break
+        elif tag == 256 or tag == 257:
+            ftype = ushort.unpack_from(ifd, entryOffset + 2)[0]
+            if ftype < 1 or ftype > len(tiffTypes):
+                raise ParserError(ImFormat.TIFF)
+            typeSize, typeStruct = tiffTypes[ftype - 1]
+            if typeSize <= 4:
+                # if type indicates that value fits into 4 bytes, value
+                # offset is not an offset but value itself
+                values = typeStruct.unpack_from(ifd, entryOffset + 4 + 4)
+            else:
+                valueOffset = ulong.unpack_from(ifd, entryOffset + 4 + 4)[0]
+                if valueOffset + typeSize <= size:
+                    values = typeStruct.unpack_from(buf, valueOffset)
+                else:
+                    input.seek(valueOffset)
+                    values = typeStruct.unpack(read_exact(input, typeSize, ImFormat.TIFF))
+
+            if ftype == 5 or ftype == 10:
+                # rational
+                a, b = values
+                if b == 0:
+                    raise ParserError(ImFormat.TIFF)
+                value = a // b
+            elif ftype == 2 or ftype == 7:
+                # ASCII and UNDEFINED
+                raise ParserError(ImFormat.TIFF)
+            else:
+                try:
+                    value = int(values[0])
+                except (ValueError, OverflowError) as error:
+                    # NaN or infinite FLOAT/DOUBLE
+                    raise ParserError(ImFormat.TIFF) from error
 
-        header_size, = unpack("<I", data[14:18])
-        if header_size == 12:
-            width, height = unpack("<hh", data[18:24])
-        else:
-            if min_size < 26 or header_size <= 12:
-                raise ParserError(ImFormat.BMP)
-            width, height = unpack("<ii", data[18:26])
-        # height is negative when stored upside down
-        return ImInfo(width, abs(height), ImFormat.BMP)
-    elif size >= 8 and (data.startswith(b"II\052\000") or data.startswith(b"MM\000\052")):
-        # from here: https://github.com/scardine/image_size
-        # Standard TIFF, big- or little-endian
-        # BigTIFF and other different but TIFF-like formats are not
-        # supported currently
-        byteOrder = data[:2]
-        # maps TIFF type id to size (in bytes)
-        # and python format char for struct
-        if byteOrder == b"MM":
-            tiffTypes = TIFF_TYPES_BE
-            ulong  = ">L"
-            ushort = ">H"
-        else:
-            tiffTypes = TIFF_TYPES_LE
-            ulong  = "<L"
-            ushort = "<H"
-        ifdOffset = unpack(ulong, data[4:8])[0]
-        try:
-            countSize = 2
-            input.seek(ifdOffset)
-            ec = input.read(countSize)
-            ifdEntryCount = unpack(ushort, ec)[0]
-            # 2 bytes: TagId + 2 bytes: type + 4 bytes: count of values + 4
-            # bytes: value offset
-            ifdEntrySize = 12
-            width  = -1
-            height = -1
-            for i in range(ifdEntryCount):
-                entryOffset = ifdOffset + countSize + i * ifdEntrySize
-                input.seek(entryOffset)
-                btag = input.read(2)
-                tag = unpack(ushort, btag)[0]
-                if tag == 256 or tag == 257:
-                    # if type indicates that value fits into 4 bytes, value
-                    # offset is not an offset but value itself
-                    btype = input.read(2)
-                    ftype = unpack(ushort, btype)[0]
-                    if ftype < 1 or ftype > len(tiffTypes):
-                        raise ParserError(ImFormat.TIFF)
-                    typeSize, typeChar = tiffTypes[ftype - 1]
-                    input.seek(entryOffset + 8)
-                    bvalue = input.read(typeSize)
-                    if ftype == 5 or ftype == 10:
-                        # rational
-                        a, b = unpack(typeChar, bvalue)[0]
-                        value = int(a) // int(b)
-                    else:
-                        value = int(unpack(typeChar, bvalue)[0])
-
-                    if value < 0:
-                        value = 0
-
-                    if tag == 256:
-                        width  = value
-                    else:
-                        height = value
-                    if width > -1 and height > -1:
-                        return ImInfo(width, height, ImFormat.TIFF)
-
-            raise ParserError(ImFormat.TIFF)
-        except Exception as error:
-            raise ParserError(ImFormat.TIFF) from error
-    elif data.startswith(b'qoif') and size >= 14:
-        # QOI
-        width, height = unpack(">II", data[4:12])
-        return ImInfo(width, height, ImFormat.QOI)
-    elif data.startswith(b'8BPS\0\x01\0\0\0\0\0\0') and size >= 22:
-        # PSD
-        height, width = unpack(">II", data[14:22])
-        return ImInfo(width, height, ImFormat.PSD)
-    elif data.startswith(b'gimp xcf ') and size >= 22 and data[13] == 0:
-        # XCF
-        width, height = unpack(">II", data[14:22])
-        return ImInfo(width, height, ImFormat.XCF)
-    elif data.startswith(b'\0\0\x01\0') and size >= 6:
-        # ICO
-        count, = unpack("<H", data[4:6])
-        input.seek(6)
-        width  = 0
-        height = 0
-        for _ in range(count):
-            data = input.read(16)
-            if len(data) < 16:
-                raise ParserError(ImFormat.ICO)
-            w = data[0]
-            h = data[1]
-            if w >= width and h >= height:
-                width  = w
-                height = h
-        return ImInfo(width, height, ImFormat.ICO)
-    elif data.startswith(b"\x76\x2f\x31\x01") and size > 8 and (data[4] == 0x01 or data[4] == 0x02):
-        # OpenEXR
-        # https://www.openexr.com/documentation/openexrfilelayout.pdf
-        input.seek(8)
-        while True:
-            name_buf = bytearray()
-            while True:
-                chunk = input.read(1)
-                if not chunk:
-                    raise ParserError(ImFormat.OpenEXR)
-                byte = chunk[0]
-                if byte == 0:
-                    break
-                name_buf.append(byte)
-
-            if len(name_buf) == 0:
-                break
-
-            type_buf = bytearray()
-            while True:
-                chunk = input.read(1)
-                if not chunk:
-                    raise ParserError(ImFormat.OpenEXR)
-                byte = chunk[0]
-                if byte == 0:
-                    break
-                type_buf.append(byte)
-
-            size_buf = input.read(4)
-            if len(size_buf) < 4:
-                raise ParserError(ImFormat.OpenEXR)
-            size, = unpack("<I", size_buf)
-
-            if name_buf == b"displayWindow":
-                if type_buf != b"box2i" or size != 16:
-                    raise ParserError(ImFormat.OpenEXR)
-
-                box_buf = input.read(16)
-                x1, y1, x2, y2 = unpack("<iiii", box_buf)
-                width  = x2 - x1 + 1
-                height = y2 - y1 + 1
-                if width <= 0 or height <= 0:
-                    raise ParserError(ImFormat.OpenEXR)
-                return ImInfo(width, height, ImFormat.OpenEXR)
+            if value < 0:
+                value = 0
+
+            if tag == 256:
+                width  = value
             else:
-                input.seek(size, 1)
-        raise ParserError(ImFormat.OpenEXR)
-    elif size >= 30 and data[0] == 0x0A and data[1] < 6 and data[2] < 2 and data[3] in (1, 2, 4, 8):
-        # PCX
-        x1, y1, x2, y2 = unpack("<HHHH", data[4:12])
-        width  = x2 - x1 + 1
-        height = y2 - y1 + 1
-        if width <= 0 or height <= 0:
-            raise ParserError(ImFormat.PCX)
-        return ImInfo(width, height, ImFormat.PCX)
-    elif size >= 20 and data.startswith(b"DDS \x7C\0\0\0") and unpack("<I", data[8:12])[0] & 0x1007:
-        # DDS
-        # http://doc.51windows.net/directx9_sdk/graphics/reference/DDSFileReference/ddsfileformat.htm
-        # https://docs.microsoft.com/en-us/windows/win32/direct3ddds/dds-header
-        height, width = unpack("<II", data[12:20])
-        return ImInfo(width, height, ImFormat.DDS)
-    elif size >= 14 and data.startswith(b"\x28\0\0\0") and data[12:14] == b"\x01\0" and data[15] == 0:
-        # DIB
-        width, height = unpack("<ii", data[4:12])
-        return ImInfo(width, abs(height), ImFormat.DIB)
-    elif size >= 20 and data.startswith(b'VTF\0'):
-        # VTF
-        header_size, width, height = unpack("<IHH", data[12:20])
-        if header_size < 20:
-            raise ParserError(ImFormat.VTF)
-        return ImInfo(width, height, ImFormat.VTF)
-    elif size >= 30 and data[1] < 2 and data[2] < 12 and is_tga(input):
-        # TGA
-        width, height = unpack("<HH", data[12:16])
-        return ImInfo(width, height, ImFormat.TGA)
+                height = value
+            if width > -1 and height > -1:
+                return ImInfo(width, height, ImFormat.TIFF)
+
+    raise ParserError(ImFormat.TIFF)
+
+def parse_qoi(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if size < 14:
+        return None
+
+    width, height = unpack(">II", data[4:12])
+    return ImInfo(width, height, ImFormat.QOI)
+
+def parse_psd(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if size < 22 or not data.startswith(b'8BPS\0\x01\0\0\0\0\0\0'):
+        return None
+
+    height, width = unpack(">II", data[14:22])
+    return ImInfo(width, height, ImFormat.PSD)
+
+def parse_xcf(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if size < 22 or not data.startswith(b'gimp xcf ') or data[13] != 0:
+        return None
+
+    width, height = unpack(">II", data[14:22])
+    return ImInfo(width, height, ImFormat.XCF)
+
+def parse_ico(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if size < 6:
+        return None
+
+    count = int.from_bytes(data[4:6], 'little')
+    # 16 bytes per directory entry, the first two are width and height
+    end = 6 + count * 16
+    if end > size:
+        input.seek(size)
+        data += read_exact(input, end - size, ImFormat.ICO)
+    width  = 0
+    height = 0
+    for offset in range(6, end, 16):
+        # 0 means 256
+        w = data[offset] or 256
+        h = data[offset + 1] or 256
+        if w >= width and h >= height:
+            width  = w
+            height = h
+    return ImInfo(width, height, ImFormat.ICO)
+
+def parse_openexr(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if size <= 8 or (data[4] != 0x01 and data[4] != 0x02):
+        return None
+
+    # https://www.openexr.com/documentation/openexrfilelayout.pdf
+    # The header is a list of attributes, each a null terminated name, a null
+    # terminated type name, the 4 byte size of the value and the value. It is
+    # scanned in CHUNK_SIZE blocks, the file position is always at the end of
+    # buf.
+    buf = data
+    pos = 8
+    while True:
+        name_end = buf.find(0, pos)
+        if name_end == pos:
+            # empty name marks the end of the header
+            break
+
+        type_end = buf.find(0, name_end + 1) if name_end >= 0 else -1
+        if type_end < 0 or type_end + 5 > len(buf):
+            chunk = input.read(CHUNK_SIZE)
+            if not chunk:
+                raise ParserError(ImFormat.OpenEXR)
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+
+        name = buf[pos:name_end]
+        type_name = buf[name_end + 1:type_end]
+        size = int.from_bytes(buf[type_end + 1:type_end + 5], 'little')
+        pos = type_end + 5
+
+        if name == b"displayWindow":
+            if type_name != b"box2i" or size != 16:
+                raise ParserError(ImFormat.OpenEXR)
+
+            if pos + 16 > len(buf):
+                buf = buf[pos:] + read_exact(input, pos + 16 - len(buf), ImFormat.OpenEXR)
+                pos = 0
+
+            x1, y1, x2, y2 = unpack_from("<iiii", buf, pos)
+            width  = x2 - x1 + 1
+            height = y2 - y1 + 1
+            if width <= 0 or height <= 0:
+                raise ParserError(ImFormat.OpenEXR)
+            return ImInfo(width, height, ImFormat.OpenEXR)
+
+        pos += size
+        if pos > len(buf):
+            input.seek(pos - len(buf), 1)
+            buf = b''
+            pos = 0
+    raise ParserError(ImFormat.OpenEXR)
+
+def parse_pcx(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if size < 30 or data[1] >= 6 or data[2] >= 2 or data[3] not in (1, 2, 4, 8):
+        return None
+
+    x1, y1, x2, y2 = unpack("<HHHH", data[4:12])
+    width  = x2 - x1 + 1
+    height = y2 - y1 + 1
+    if width <= 0 or height <= 0:
+        raise ParserError(ImFormat.PCX)
+    return ImInfo(width, height, ImFormat.PCX)
+
+def parse_dds(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if size < 20 or not data.startswith(b"DDS \x7C\0\0\0") or not int.from_bytes(data[8:12], 'little') & 0x1007:
+        return None
+
+    # http://doc.51windows.net/directx9_sdk/graphics/reference/DDSFileReference/ddsfileformat.htm
+    # https://docs.microsoft.com/en-us/windows/win32/direct3ddds/dds-header
+    height, width = unpack("<II", data[12:20])
+    return ImInfo(width, height, ImFormat.DDS)
+
+def parse_dib(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    if not data.startswith(b"\x01\0", 12) or data[15:16] != b"\0":
+        return None
+
+    width, height = unpack("<ii", data[4:12])
+    return ImInfo(width, abs(height), ImFormat.DIB)
+
+def parse_vtf(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if size < 20:
+        return None
+
+    header_size, width, height = unpack("<IHH", data[12:20])
+    if header_size < 20:
+        raise ParserError(ImFormat.VTF)
+    return ImInfo(width, height, ImFormat.VTF)
+
+def parse_tga(input: IO[bytes], data: bytes) -> Optional[ImInfo]:
+    size = len(data)
+    if size < 30 or data[1] >= 2 or data[2] >= 12 or not is_tga(input):
+        return None
+
+    width, height = unpack("<HH", data[12:16])
+    return ImInfo(width, height, ImFormat.TGA)
+
+Parser = Callable[[IO[bytes], bytes], Optional[ImInfo]]
+
+# Maps a slice at a fixed offset of the start of a file to the parser of the
+# only format that can have these bytes there. The slices are probed in order
+# and each lookup is a single dict access. A parser returns None if the rest
+# of the header doesn't match after all.
+# The ISO BMFF brand comes first: the size of the ftyp box in front of it can
+# look like another signature (e.g. a 256 byte box starts like an ICO file).
+SIGNATURES: Tuple[Tuple[int, int, Dict[bytes, Parser]], ...] = (
+    (4, 12, {
+        b'ftypavif': parse_avif,
+        b'ftypheic': parse_avif,
+    }),
+    (0, 4, {
+        b'GIF8'            : parse_gif,
+        b'\x89PNG'         : parse_png,
+        b'RIFF'            : parse_webp,
+        b'\0\0\0\x0C'      : parse_jp2k,
+        b'II\x2a\0'        : parse_tiff,
+        b'MM\0\x2a'        : parse_tiff,
+        b'qoif'            : parse_qoi,
+        b'8BPS'            : parse_psd,
+        b'gimp'            : parse_xcf,
+        b'\0\0\x01\0'      : parse_ico,
+        b'\x76\x2f\x31\x01': parse_openexr,
+        b'DDS '            : parse_dds,
+        b'\x28\0\0\0'      : parse_dib,
+        b'VTF\0'           : parse_vtf,
+    }),
+    (0, 2, {
+        b'\xff\xd8': parse_jpeg,
+        b'BM'      : parse_bmp,
+    }),
+    (0, 1, {
+        b'\x0A': parse_pcx,
+    }),
+)
+
+# Formats without a fixed signature at the start of the file.
+FALLBACK_PARSERS: Tuple[Parser, ...] = (
+    parse_tga,
+)
+
+def get_image_size_from_reader(input: IO[bytes]) -> ImInfo:
+    """
+    Return (width, height, format) for a given image file content.
+    input must be seekable. May raise ImError.
+    """
+
+    # One read is enough for the headers of most formats. The size checks
+    # in the parsers only ever need to know if the file is at least a few
+    # bytes long, so the length of this prefix can stand in for the file size.
+    data = input.read(CHUNK_SIZE)
+
+    for start, end, parsers in SIGNATURES:
+        parser = parsers.get(data[start:end])
+        if parser is not None:
+            info = parser(input, data)
+            if info is not None:
+                return info
+
+    for parser in FALLBACK_PARSERS:
+        info = parser(input, data)
+        if info is not None:
+            return info
 
     raise UnsupportedFormat()
 
 def main() -> None:
     import sys
-    for path in sys.argv[1:]:
-        if isdir(path):
-            for parent, dirnames, filenames in walk(path):
-                for filename in filenames:
-                    file_path = join_path(parent, filename)
-                    try:
-                        width, height, format = get_image_size(file_path)
-                    except Exception as error:
-                        print(f'*** error: {file_path}:', error, file=sys.stderr)
-                    else:
-                        print(f"{file_path}: {format}, {width} x {height}")
-        else:
-            file_path = path
-            try:
-                width, height, format = get_image_size(file_path)
-            except Exception as error:
-                print(f'*** error: {file_path}:', error, file=sys.stderr)
+    from os import walk, cpu_count
+    from os.path import isdir, join as join_path
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor, Future
+
+    def iter_paths() -> Iterator[str]:
+        for path in sys.argv[1:]:
+            if isdir(path):
+                for parent, dirnames, filenames in walk(path):
+                    for filename in filenames:
+                        yield join_path(parent, filename)
+            else:
+                yield path
+
+    def safe_get_image_size(file_path: str) -> Tuple[str, Union[ImInfo, Exception]]:
+        try:
+            return file_path, get_image_size_cached(file_path)
+        except Exception as error:
+            return file_path, error
+
+    def iter_results(pool: ThreadPoolExecutor, max_pending: int) -> Iterator[Tuple[str, Union[ImInfo, Exception]]]:
+        # unlike pool.map() this doesn't submit all paths up front, so output
+        # starts before the directory walk is done and memory stays bounded
+        pending: 'deque[Future[Tuple[str, Union[ImInfo, Exception]]]]' = deque()
+        for file_path in iter_paths():
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(pool.submit(safe_get_image_size, file_path))
+
+        while pending:
+            yield pending.popleft().result()
+
+    # reading the headers is I/O bound, so overlap it in threads
+    # results are yielded in the order of the paths
+    max_workers = min(32, (cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for file_path, result in iter_results(pool, max_workers * 2):
+            if isinstance(result, Exception):
+                print(f'*** error: {file_path}:', result, file=sys.stderr)
             else:
+                width, height, format = result
                 print(f"{file_path}: {format}, {width} x {height}")
 
 if __name__ == '__main__':